@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+def user_dir(xdg_variable, default):
+    # Per-user fslflash directory, under the given XDG base directory or LOCALAPPDATA on Windows
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get(xdg_variable, os.path.expanduser(default))
+    return os.path.join(base, 'fslflash')
+
+def cache_dir():
+    return user_dir('XDG_CACHE_HOME', '~/.cache')
+
+def load(name):
+    try:
+        with open(os.path.join(cache_dir(), name + '.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Missing or corrupt cache is the same as an empty one
+        return {}
+
+def save(name, data):
+    directory = cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file and rename so a concurrent run never sees a partial file
+    (fd, tmpname) = tempfile.mkstemp(dir=directory, prefix=name, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmpname, os.path.join(directory, name + '.json'))
+
+def device_id(device):
+    # VID:PID:bcdDevice identifies the u-boot build
+    return '{0:04x}:{1:04x}:{2:04x}'.format(device.getVendorID(), device.getProductID(), device.getbcdDevice())
+
+def device_key(device):
+    # Bus and port path identify the host port
+    ports = '.'.join(str(port) for port in device.getPortNumberList())
+    return '{0}@{1}-{2}'.format(device_id(device), device.getBusNumber(), ports)
+
+def config_hash(device):
+    # Built from the descriptors libusb read at enumeration, so costs no USB traffic
+    settings = [(setting.getNumber(), setting.getAlternateSetting(), setting.getClassTuple(), setting.getDescriptor())
+            for setting in device.iterSettings()]
+    return hashlib.sha1(repr(settings).encode()).hexdigest()
@@ -1,4 +1,5 @@
 import binascii
+import contextlib
 import datetime
 import itertools
 import os
@@ -12,13 +13,66 @@ import zipfile
 import libusb1
 import usb1
 
+from fsl import cache
+from fsl import history
+from fsl import tuning
+from fsl import ubootenv
+from fsl.ubootenv import UBOOTENV_SIZE
+
 # From mtdparts, update when flash partitions change.
 # Unfortunately you can't just give a partition name when flashing, have to know the offset
 
 OFFSETS = { 'fcb-area': '0x00000000', 'uboot': '0x00040000', 'uboot-var': '0x000C0000', 'fdt': '0x000E0000', 'kernel-image': '0x00100000', 'user-data': '0x00900000', 'rootfs': '0x01100000' }
 #BOOTSTRAP_ADDR = 0x3f408000
 BOOTSTRAP_ADDR = 0x3f4078e8
-UBOOTENV_SIZE = 0x20000
+DESCRIPTOR_CACHE = 'descriptors'
+
+class FlashGeometry:
+    # Spare area sizes the NFC ECC modes can work with, per page size
+    OOB_SIZES = { 512: (16,), 2048: (64, 128), 4096: (128, 224, 256) }
+
+    def __init__(self, page_size=2048, erase_size=0x20000, oob_size=64):
+        if oob_size not in FlashGeometry.OOB_SIZES.get(page_size, ()):
+            raise ValueError('Unsupported NAND geometry, page size 0x{0:x} with oob size 0x{1:x}'.format(page_size, oob_size))
+        if erase_size % page_size != 0:
+            raise ValueError('Erase block size 0x{0:x} is not a multiple of page size 0x{1:x}'.format(erase_size, page_size))
+        for partition, offset in OFFSETS.items():
+            if int(offset, 16) % erase_size != 0:
+                raise ValueError('Partition {0} at {1} is not aligned to erase block size 0x{2:x}'.format(partition, offset, erase_size))
+        self.page_size = page_size
+        self.erase_size = erase_size
+        self.oob_size = oob_size
+
+    def __str__(self):
+        return 'NAND geometry -- page size: 0x{0:x}, erase block size: 0x{1:x}, oob size: 0x{2:x}'.format(
+                self.page_size, self.erase_size, self.oob_size)
+
+    def chunk_size(self, max_size):
+        # Largest chunk no bigger than max_size that is a whole number of pages and
+        # either divides the erase block or is a whole number of erase blocks, so that
+        # chunk boundaries never split a page or straddle an erase block unevenly.
+        if max_size >= self.erase_size:
+            return max_size - max_size % self.erase_size
+        chunk_size = self.erase_size
+        while chunk_size > max_size and chunk_size > self.page_size:
+            chunk_size //= 2
+        if chunk_size > max_size or self.erase_size % chunk_size != 0 or chunk_size % self.page_size != 0:
+            # Transfer size smaller than a page, or odd geometry, nothing to align to
+            return max_size
+        return chunk_size
+
+    def pad(self, imagedata):
+        # Pad to a whole page with erased flash contents so the last program is not partial
+        remainder = len(imagedata) % self.page_size
+        if remainder != 0:
+            imagedata += b'\xff' * (self.page_size - remainder)
+        return imagedata
+
+NAND_GEOMETRY = FlashGeometry()
+
+def chunk_schedule(length, max_size, geometry=None):
+    chunk_size = geometry.chunk_size(max_size) if geometry else max_size
+    return [(offset, min(chunk_size, length - offset)) for offset in range(0, length, chunk_size)]
 
 class CBW:
     SIGNATURE = 0x43425355
@@ -98,13 +152,16 @@ class UTP:
 class Vybrid:
     VENDOR_ID = 0x066f
     PRODUCT_ID = 0x37ff
+    PROTOCOL = 'ums'
+    CHUNK_SIZE = 65536
+    ENV_PARTITION = 'uboot-var'
 
     UTP_POLL = 0
     UTP_EXEC = 1
     UTP_GET  = 2
     UTP_PUT  = 3
 
-    def __init__(self, handle, statusio=sys.stdout):
+    def __init__(self, handle, statusio=sys.stdout, geometry=NAND_GEOMETRY):
         self.tag = itertools.count(start=1)
         self.handle = handle
         try:
@@ -113,6 +170,9 @@ class Vybrid:
             pass
         self.handle.claimInterface(0)
         self.statusio = statusio
+        self.geometry = geometry
+        self.chunk_size = Vybrid.CHUNK_SIZE
+        self.retries = 0
 
     def do_ping(self):
         utp = UTP(UTP.UTP_POLL, next(self.tag))
@@ -135,6 +195,9 @@ class Vybrid:
         self.handle.bulkWrite(1, data[offset:offset+length])
         csw = CSW.unpack(self.handle.bulkRead(1, 13))
 
+    def has_partition(self, partition):
+        return partition in OFFSETS
+
     def load_file(self, partition, imagefilename):
         self.statusio.write('\nLoading partition {0} from {1}\n'.format(partition, imagefilename))
         with open(imagefilename, 'rb') as f:
@@ -146,17 +209,14 @@ class Vybrid:
         self.do_ping()
         self.do_exec('pipenand addr={0}'.format(OFFSETS[partition]))
 
-        offset = 0
-        num_chunks = len(imagedata)//65536
-        if len(imagedata) % 65536 != 0:
-            num_chunks += 1
-        while offset < len(imagedata):
-            chunk_size = min(65536, len(imagedata) - offset)
-            self.statusio.write('Uploading firmware image chunk {0}/{1}\r'.format(offset//65536+1, num_chunks))
+        if self.geometry:
+            imagedata = self.geometry.pad(imagedata)
+        chunks = chunk_schedule(len(imagedata), self.chunk_size, self.geometry)
+        for (chunk_index, (offset, chunk_size)) in enumerate(chunks):
+            self.statusio.write('Uploading firmware image chunk {0}/{1}\r'.format(chunk_index+1, len(chunks)))
             self.statusio.flush()
             self.do_ping()
             self.do_put(imagedata, offset, chunk_size)
-            offset += chunk_size
         self.statusio.write('\n')
         return True
 
@@ -169,6 +229,10 @@ class Vybrid:
         self.do_exec('nandinit addr={0}'.format(OFFSETS['uboot']))
         self.do_ping()
 
+    def load_env(self, envimage):
+        self.statusio.write('\nLoading partition {0} from u-boot environment image\n'.format(self.ENV_PARTITION))
+        return self.load_image(self.ENV_PARTITION, envimage)
+
     def set_serial(self, serial):
         serialtext = '{0:06d}'.format(serial)
         macaddr = '{0}:{1}:{2}'.format(serialtext[:2], serialtext[2:4], serialtext[4:])
@@ -273,7 +337,74 @@ class Bootstrap:
         except libusb1.USBError:
             pass
 
+class DFUDownload:
+    # What to do when a busy device reports bwPollTimeout of 0, which some u-boot builds always do
+    ZERO_POLL_IMMEDIATE = 'immediate'
+    ZERO_POLL_FIXED = 'fixed'
+    ZERO_POLL_BACKOFF = 'backoff'
+    ZERO_POLL_STRATEGIES = (ZERO_POLL_IMMEDIATE, ZERO_POLL_FIXED, ZERO_POLL_BACKOFF)
+    ZERO_POLL_INTERVAL = 0.001
+    ZERO_POLL_MAX_INTERVAL = 0.032
+
+    def __init__(self, dfu, zero_poll=ZERO_POLL_BACKOFF):
+        if zero_poll not in DFUDownload.ZERO_POLL_STRATEGIES:
+            raise ValueError('Unknown zero poll timeout strategy {0}'.format(zero_poll))
+        self.dfu = dfu
+        self.zero_poll = zero_poll
+        self.busy_times = []
+        self.poll_counts = []
+        self.manifest_time = None
+        self.manifest_polls = 0
+
+    def __str__(self):
+        if not self.busy_times:
+            return 'DFU download -- no blocks'
+        summary = 'DFU download -- blocks: {0}, busy: {1:.3f}s total, {2:.1f}ms mean, {3:.1f}ms max, status polls: {4}'.format(
+                len(self.busy_times), sum(self.busy_times), sum(self.busy_times) * 1000 / len(self.busy_times),
+                max(self.busy_times) * 1000, sum(self.poll_counts))
+        if self.manifest_time is not None:
+            summary += ', manifest: {0:.1f}ms, {1} status polls'.format(self.manifest_time * 1000, self.manifest_polls)
+        return summary
+
+    def poll_interval(self, timeout, attempt):
+        if timeout:
+            return timeout / 1000
+        if self.zero_poll == DFUDownload.ZERO_POLL_IMMEDIATE:
+            return 0
+        if self.zero_poll == DFUDownload.ZERO_POLL_FIXED:
+            return DFUDownload.ZERO_POLL_INTERVAL
+        return min(DFUDownload.ZERO_POLL_INTERVAL * 2 ** attempt, DFUDownload.ZERO_POLL_MAX_INTERVAL)
+
+    def wait(self, busy_states, prepare=None, manifest=False):
+        # prepare() runs once inside the device's busy period, its result is returned with the final status
+        start = time.monotonic()
+        (status, timeout, state) = self.dfu.get_status()
+        polls = 1
+        prepared = None
+        while state in busy_states:
+            # bwPollTimeout counts from the GET_STATUS response, only sleep for what is left after prepare()
+            deadline = time.monotonic() + self.poll_interval(timeout, polls - 1)
+            if prepare:
+                prepared = prepare()
+                prepare = None
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            (status, timeout, state) = self.dfu.get_status()
+            polls += 1
+        if manifest:
+            self.manifest_time = time.monotonic() - start
+            self.manifest_polls = polls
+        else:
+            self.busy_times.append(time.monotonic() - start)
+            self.poll_counts.append(polls)
+        if prepare:
+            prepared = prepare()
+        return (status, state, prepared)
+
 class DFU:
+    PROTOCOL = 'dfu'
+    ENV_PARTITION = 'u-boot-env'
     CLASS_TUPLE = (libusb1.LIBUSB_CLASS_APPLICATION, 0x01)
     REQUEST_TYPE = libusb1.LIBUSB_TYPE_CLASS | libusb1.LIBUSB_RECIPIENT_INTERFACE
 
@@ -331,7 +462,7 @@ class DFU:
     STATE_DFU_UPLOAD_IDLE = 9
     STATE_DFU_ERROR = 10
 
-    def __init__(self, handle, statusio=sys.stdout):
+    def __init__(self, handle, statusio=sys.stdout, geometry=NAND_GEOMETRY, zero_poll=DFUDownload.ZERO_POLL_BACKOFF):
         self.handle = handle
         try:
             self.handle.setAutoDetachKernelDriver(True)
@@ -339,20 +470,65 @@ class DFU:
             pass
         self.handle.claimInterface(0)
         self.statusio = statusio
+        self.geometry = geometry
+        self.zero_poll = zero_poll
+        self.download = None
+        self.retries = 0
         self.partition_alt = {}
+        self.verified = set()
+        self.probed = False
+        device = handle.getDevice()
+        self.descriptor_key = '{0}:{1}'.format(cache.device_id(device), cache.config_hash(device))
+        cached = cache.load(DESCRIPTOR_CACHE).get(self.descriptor_key)
+        if cached:
+            # Alt setting names are checked lazily by verify() on first use
+            self.transfer_size = cached['transfer_size']
+            self.partition_alt = cached['partition_alt']
+        else:
+            self.probe()
+        self.chunk_size = self.transfer_size
+
+    def probe(self):
         # Descriptor type 0x21 is used for DFU Functional Descriptor or maybe HID descriptor..
         # libusb1 getExtra() is returning empty so manually send the control read request to
         # retrieve functional descriptor 0x21 (DFU spec 4.1.3)
         # Send GET_DESCRIPTOR request for descriptor 0x21, interface 0, length of 9 bytes
-        functional = handle.controlRead(libusb1.LIBUSB_ENDPOINT_IN, 
+        functional = self.handle.controlRead(libusb1.LIBUSB_ENDPOINT_IN, 
                 libusb1.LIBUSB_REQUEST_GET_DESCRIPTOR, (0x21 << 8), 0, 9, timeout=5000)
         # See 4.1.3 for details, all we care about for now is wTransferSize
         (_, _, self.transfer_size, _) = struct.unpack('<BHHH', functional[2:])
-        for setting in handle.getDevice().iterSettings():
-            if setting.getClassTuple() == (libusb1.LIBUSB_CLASS_APPLICATION, 0x01):
+        self.partition_alt = {}
+        for setting in self.handle.getDevice().iterSettings():
+            if setting.getClassTuple() == DFU.CLASS_TUPLE:
                 index = setting.getDescriptor()
-                desc = handle.getASCIIStringDescriptor(index)
+                desc = self.handle.getASCIIStringDescriptor(index)
                 self.partition_alt[desc] = setting.getAlternateSetting()
+        self.verified = set(self.partition_alt)
+        self.probed = True
+        descriptors = cache.load(DESCRIPTOR_CACHE)
+        descriptors[self.descriptor_key] = { 'transfer_size': self.transfer_size, 'partition_alt': self.partition_alt }
+        try:
+            cache.save(DESCRIPTOR_CACHE, descriptors)
+        except OSError as e:
+            # The cache only saves time, flashing works without it
+            self.statusio.write('Could not save DFU descriptor cache: {0}\n'.format(e))
+
+    def verify(self, partition):
+        # Make sure a cached alt setting still carries the partition name, re-probe if not
+        if partition in self.verified:
+            return
+        alt = self.partition_alt.get(partition)
+        for setting in self.handle.getDevice().iterSettings():
+            if setting.getClassTuple() == DFU.CLASS_TUPLE and setting.getAlternateSetting() == alt:
+                if self.handle.getASCIIStringDescriptor(setting.getDescriptor()) == partition:
+                    self.verified.add(partition)
+                    return
+        self.statusio.write('Cached DFU descriptors are stale, probing device\n')
+        self.probe()
+        self.chunk_size = min(self.chunk_size, self.transfer_size)
+
+    def has_partition(self, partition):
+        return partition in self.partition_alt
 
     def control_write(self, bRequest, wValue, data):
         self.handle.controlWrite(DFU.REQUEST_TYPE, bRequest, wValue, 0, data, timeout=5000)
@@ -385,28 +561,34 @@ class DFU:
         self.statusio.flush()
         return False
 
-    def check_dnload(self):
-        (status, timeout, state) = self.get_status()
-        while state == DFU.STATE_DFU_DNBUSY:
-            time.sleep(timeout / 1000)
-            (status, timeout, state) = self.get_status()
+    def check_dnload(self, prepare=None):
+        (status, state, prepared) = self.download.wait((DFU.STATE_DFU_DNLOAD_SYNC, DFU.STATE_DFU_DNBUSY), prepare)
         if state == DFU.STATE_DFU_DNLOAD_IDLE:
-            return True
+            return (True, prepared)
         self.statusio.write('\nDFU device is in {} state, expected DFU_DNLOAD-IDLE or DFU_DNBUSY state.  Status: {}\n'.format(DFU.STATE_DICT[state], DFU.STATUS_DICT[status]))
         self.statusio.flush()
-        return False
+        return (False, prepared)
 
     def complete_dnload(self):
-        (status, timeout, state) = self.get_status()
-        while state in (DFU.STATE_DFU_MANIFEST, DFU.STATE_DFU_MANIFEST_SYNC):
-            time.sleep(timeout / 1000)
-            (status, timeout, state) = self.get_status()
+        (status, state, _) = self.download.wait((DFU.STATE_DFU_MANIFEST, DFU.STATE_DFU_MANIFEST_SYNC), manifest=True)
         if state == DFU.STATE_DFU_IDLE:
             return True
         self.statusio.write('\nDFU device is in {} state, expected DFU_IDLE.  Status: {}\n'.format(DFU.STATE_DICT[state], DFU.STATUS_DICT[status]))
         self.statusio.flush()
         return False
 
+    def prepare_chunk(self, imagedata, chunks, chunk_index):
+        if chunk_index >= len(chunks):
+            # 0 length download request to finish
+            return b''
+        percent = chunk_index * 100 // len(chunks)
+        if percent != self.percent:
+            self.statusio.write('Uploading firmware image {}%\r'.format(percent))
+            self.statusio.flush()
+            self.percent = percent
+        (offset, chunk_size) = chunks[chunk_index]
+        return imagedata[offset:offset+chunk_size]
+
     def load_file(self, partition, imagefilename):
         self.statusio.write('\nLoading partition {0} from {1}\n'.format(partition, imagefilename))
         with open(imagefilename, 'rb') as f:
@@ -414,32 +596,43 @@ class DFU:
             return self.load_image(partition, imagedata)
 
     def load_image(self, partition, imagedata):
+        try:
+            return self.download_image(partition, imagedata)
+        except libusb1.USBError:
+            # wTransferSize is not covered by the descriptor cache key, a rebuilt u-boot with a
+            # smaller one stalls the first DNLOAD. Re-probe and retry once in that case.
+            if self.probed or self.download is None or self.download.busy_times:
+                raise
+            self.statusio.write('\nDFU download stalled with cached descriptors, probing device\n')
+            self.retries += 1
+            self.control_write(DFU.CLR_STATUS, 0, b'')
+            self.probe()
+            self.chunk_size = min(self.chunk_size, self.transfer_size)
+            return self.download_image(partition, imagedata)
+
+    def download_image(self, partition, imagedata):
+        self.download = None
+        self.verify(partition)
         self.handle.setInterfaceAltSetting(0, self.partition_alt[partition])
         if not self.check_idle():
             return False
-        offset = 0
-        num_chunks = len(imagedata)//self.transfer_size
-        old_percent = None
-        if len(imagedata) % self.transfer_size != 0:
-            num_chunks += 1
-        while offset < len(imagedata):
-            chunk_size = min(self.transfer_size, len(imagedata) - offset)
-            chunk_index = offset//self.transfer_size
-            percent = chunk_index * 100 // num_chunks
-            if percent != old_percent:
-                self.statusio.write('Uploading firmware image {}%\r'.format(percent))
-                self.statusio.flush()
-                old_percent = percent
-            chunk = imagedata[offset:offset+chunk_size]
-            offset += chunk_size
+        if self.geometry:
+            imagedata = self.geometry.pad(imagedata)
+        chunks = chunk_schedule(len(imagedata), min(self.chunk_size, self.transfer_size), self.geometry)
+        self.download = DFUDownload(self, self.zero_poll)
+        self.percent = None
+        chunk = self.prepare_chunk(imagedata, chunks, 0)
+        for chunk_index in range(len(chunks)):
             self.do_dnload(chunk_index, chunk)
-            if not self.check_dnload():
+            # Slice the next block and report progress while the device programs this one
+            (ok, chunk) = self.check_dnload(lambda: self.prepare_chunk(imagedata, chunks, chunk_index + 1))
+            if not ok:
                 return False
-        # 0 length download request to finish
-        self.do_dnload(num_chunks, b'')
+        self.do_dnload(len(chunks), chunk)
         if not self.complete_dnload():
             return False
-        self.statusio.write('Uploading firmware image 100%\n\n')
+        self.statusio.write('Uploading firmware image 100%\n')
+        self.statusio.write('{0}\n\n'.format(self.download))
         self.statusio.flush()
         return True
 
@@ -449,6 +642,10 @@ class DFU:
         self.load_file('u-boot', imagefilename)
         self.do_exec('writebcb {0}'.format(OFFSETS['uboot']))
 
+    def load_env(self, envimage):
+        self.statusio.write('\nLoading partition {0} from u-boot environment image\n'.format(self.ENV_PARTITION))
+        return self.load_image(self.ENV_PARTITION, envimage)
+
     def set_serial(self, serial):
         serialtext = '{0:06d}'.format(serial)
         macaddr = '{0}:{1}:{2}'.format(serialtext[:2], serialtext[2:4], serialtext[4:])
@@ -486,6 +683,7 @@ class FirmwareZip:
         self.zipfile = zipfile.ZipFile(filename, 'r')
         self.bootstrap = None
         self.uboot = None
+        self.ubootenv = None
         self.kernel = None
         self.fdt = None
         self.rootfs = None
@@ -503,6 +701,8 @@ class FirmwareZip:
                     self.bootstrap = filename
                 elif partition == 'u-boot':
                     self.uboot = filename
+                elif partition == 'u-boot-env':
+                    self.ubootenv = filename
                 elif partition == 'kernel-image':
                     self.kernel = filename
                 elif partition == 'fdt':
@@ -514,7 +714,7 @@ class FirmwareZip:
     def __exit__(self, exception_type, exception_value, exception_traceback):
         shutil.rmtree(self.tmpdir, ignore_errors=True)
 
-def get_vybrid(statusio, bootstrap_image=None):
+def get_vybrid(statusio, bootstrap_image=None, geometry=NAND_GEOMETRY, zero_poll=DFUDownload.ZERO_POLL_BACKOFF, session=None):
     ctx = usb1.USBContext()
     vybrid = None
     statusio.write('Looking for Vybrid...\n')
@@ -531,7 +731,8 @@ def get_vybrid(statusio, bootstrap_image=None):
                     raise RuntimeError('Vybrid in bootrom mode, no bootstrap file specified')
                 handle = device.open()
                 bootstrap = Bootstrap(handle, statusio)
-                bootstrap.load_image(bootstrap_image)
+                with session.phase('bootstrap', len(bootstrap_image), 'sdp') if session else contextlib.nullcontext():
+                    bootstrap.load_image(bootstrap_image)
                 bootstrap.close()
                 time.sleep(0.3)
                 break
@@ -540,49 +741,94 @@ def get_vybrid(statusio, bootstrap_image=None):
                 if device[0][0][0].getClassTuple() == (0xfe, 0x01):
                     statusio.write('Found DFU Vybrid\n')
                     statusio.flush()
-                    vybrid = DFU(handle, statusio)
+                    vybrid = DFU(handle, statusio, geometry, zero_poll)
                 else:
                     statusio.write('Found UMS Vybrid\n')
                     statusio.flush()
-                    vybrid = Vybrid(handle, statusio)
+                    vybrid = Vybrid(handle, statusio, geometry)
+                if tuning.apply(vybrid):
+                    statusio.write('Using tuned chunk size 0x{0:x}\n'.format(vybrid.chunk_size))
                 break
         if not vybrid:
             time.sleep(0.1)
     return vybrid
 
-def flash_package(zipfile, reboot=False, statusio=sys.stdout):
-    with FirmwareZip(zipfile) as f:
-        flash(f.bootstrap, f.uboot, f.fdt, f.kernel, f.rootfs, None, reboot, statusio)
-
-def flash(bootstrap_file=None, uboot_file=None, fdt_file=None, kernel_file=None, rootfs_file=None, serial=None, reboot=False, statusio=sys.stdout):
+def tune(partition, bootstrap_file=None, statusio=sys.stdout, geometry=NAND_GEOMETRY, zero_poll=DFUDownload.ZERO_POLL_BACKOFF):
     bootstrap_image = None
     if bootstrap_file:
         with open(bootstrap_file, 'rb') as f:
             bootstrap_image = f.read()
 
-    vybrid = get_vybrid(statusio, bootstrap_image)
-
-    # if u-boot provided, boot into it before continuing in case partitions have changed
-    if uboot_file:
-        vybrid.load_uboot(uboot_file)
-        vybrid.reboot()
-        time.sleep(0.3)
-        vybrid = get_vybrid(statusio, bootstrap_image)
-
-    if fdt_file:
-        vybrid.load_file('fdt', fdt_file)
-
-    if kernel_file:
-        vybrid.load_file('kernel-image', kernel_file)
+    vybrid = get_vybrid(statusio, bootstrap_image, geometry, zero_poll)
+    try:
+        tuning.calibrate(vybrid, partition, statusio)
+    finally:
+        vybrid.close()
 
-    if rootfs_file:
-        vybrid.load_file('rootfs', rootfs_file)
+def check_env_partition(vybrid):
+    if not vybrid.has_partition(vybrid.ENV_PARTITION):
+        raise RuntimeError('{0} Vybrid has no {1} partition for the u-boot environment'.format(vybrid.PROTOCOL.upper(), vybrid.ENV_PARTITION))
 
-    if serial:
-        vybrid.set_serial(serial)
+def flash_package(zipfile, reboot=False, statusio=sys.stdout, geometry=NAND_GEOMETRY, zero_poll=DFUDownload.ZERO_POLL_BACKOFF, env_serial=None):
+    with FirmwareZip(zipfile) as f:
+        flash(f.bootstrap, f.uboot, f.fdt, f.kernel, f.rootfs, None, reboot, statusio, geometry, zero_poll, f.ubootenv,
+              os.path.basename(zipfile), env_serial)
 
-    if reboot:
-        vybrid.reboot()
-    else:
-        vybrid.close()
+def flash(bootstrap_file=None, uboot_file=None, fdt_file=None, kernel_file=None, rootfs_file=None, serial=None, reboot=False, statusio=sys.stdout, geometry=NAND_GEOMETRY, zero_poll=DFUDownload.ZERO_POLL_BACKOFF, ubootenv_file=None, package=None, env_serial=None):
+    bootstrap_image = None
+    if bootstrap_file:
+        with open(bootstrap_file, 'rb') as f:
+            bootstrap_image = f.read()
 
+    # Render the environment before touching the unit, so a template that needs a
+    # serial number fails here rather than after u-boot-env has been erased.
+    # env_serial only fills in the environment, serial also programs the EEPROM.
+    envimage = None
+    if ubootenv_file:
+        with open(ubootenv_file, 'rb') as f:
+            envimage = ubootenv.build(f.read(), UBOOTENV_SIZE, env_serial if env_serial is not None else serial)
+
+    with history.Session(package) as session:
+        with session.phase(history.CONNECT_PHASE):
+            vybrid = get_vybrid(statusio, bootstrap_image, geometry, zero_poll, session)
+        session.set_device(vybrid)
+        if envimage:
+            check_env_partition(vybrid)
+
+        # if u-boot provided, boot into it before continuing in case partitions have changed
+        if uboot_file:
+            with session.phase('uboot', os.path.getsize(uboot_file), vybrid=vybrid):
+                vybrid.load_uboot(uboot_file)
+            with session.phase('reboot'):
+                vybrid.reboot()
+                time.sleep(0.3)
+                vybrid = get_vybrid(statusio, bootstrap_image, geometry, zero_poll, session)
+            session.set_device(vybrid)
+            if envimage:
+                check_env_partition(vybrid)
+
+        # Written while u-boot runs from its default environment, picked up on the next boot
+        if envimage:
+            with session.phase('uboot-var', len(envimage), vybrid=vybrid) as phase:
+                phase.result = vybrid.load_env(envimage)
+
+        if fdt_file:
+            with session.phase('fdt', os.path.getsize(fdt_file), vybrid=vybrid) as phase:
+                phase.result = vybrid.load_file('fdt', fdt_file)
+
+        if kernel_file:
+            with session.phase('kernel-image', os.path.getsize(kernel_file), vybrid=vybrid) as phase:
+                phase.result = vybrid.load_file('kernel-image', kernel_file)
+
+        if rootfs_file:
+            with session.phase('rootfs', os.path.getsize(rootfs_file), vybrid=vybrid) as phase:
+                phase.result = vybrid.load_file('rootfs', rootfs_file)
+
+        if serial:
+            with session.phase('serial'):
+                vybrid.set_serial(serial)
+
+        if reboot:
+            vybrid.reboot()
+        else:
+            vybrid.close()
@@ -0,0 +1,204 @@
+import datetime
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from fsl import cache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    duration REAL,
+    station TEXT,
+    device TEXT,
+    protocol TEXT,
+    package TEXT,
+    bytes INTEGER,
+    retries INTEGER,
+    outcome TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+    session INTEGER REFERENCES sessions(id),
+    phase TEXT,
+    started REAL,
+    duration REAL,
+    bytes INTEGER,
+    protocol TEXT,
+    outcome TEXT,
+    retries INTEGER
+);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions(started);
+'''
+
+CONNECT_PHASE = 'connect'
+
+def history_path():
+    return os.path.join(cache.user_dir('XDG_DATA_HOME', '~/.local/share'), 'history.sqlite')
+
+def connect(path=None):
+    path = path or history_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=30)
+    db.executescript(SCHEMA)
+    # Databases written before phases recorded retries
+    if 'retries' not in [column[1] for column in db.execute('PRAGMA table_info(phases)')]:
+        db.execute('ALTER TABLE phases ADD COLUMN retries INTEGER DEFAULT 0')
+    return db
+
+class Phase:
+    def __init__(self, session, name, nbytes=0, protocol=None, vybrid=None):
+        self.session = session
+        self.name = name
+        self.bytes = nbytes
+        self.protocol = protocol
+        self.vybrid = vybrid
+        self.result = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.first_nested = len(self.session.phases)
+        self.first_retries = self.vybrid.retries if self.vybrid else 0
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if exception_type:
+            outcome = 'error'
+        elif self.result is False:
+            outcome = 'failed'
+        else:
+            outcome = 'ok'
+        # Phases only record their own time, not that of phases nested inside them
+        duration = time.monotonic() - self.start - sum(phase[2] for phase in self.session.phases[self.first_nested:])
+        if self.name == CONNECT_PHASE:
+            self.session.waiting += duration
+        retries = self.vybrid.retries - self.first_retries if self.vybrid else 0
+        self.session.phases.append((self.name, self.started, duration, self.bytes, self.protocol or self.session.protocol, outcome, retries))
+        return False
+
+class Session:
+    # Rows are kept in memory while flashing and written in one transaction from a
+    # separate thread when the session ends, so the database never slows the upload.
+    def __init__(self, package=None, path=None):
+        self.package = package
+        self.path = path
+        self.device = None
+        self.protocol = None
+        self.waiting = 0
+        self.phases = []
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if exception_type:
+            outcome = 'error'
+        elif any(phase[5] != 'ok' for phase in self.phases):
+            outcome = 'failed'
+        else:
+            outcome = 'ok'
+        # Time spent waiting for the operator to plug the unit in is not flashing time
+        self.duration = time.monotonic() - self.start - self.waiting
+        threading.Thread(target=self.write, args=(outcome,)).start()
+        return False
+
+    def set_device(self, vybrid):
+        self.device = cache.device_key(vybrid.handle.getDevice())
+        self.protocol = vybrid.PROTOCOL
+
+    def phase(self, name, nbytes=0, protocol=None, vybrid=None):
+        # Pass the vybrid for phases that upload, so retries it makes are recorded
+        return Phase(self, name, nbytes, protocol, vybrid)
+
+    def write(self, outcome):
+        try:
+            db = connect(self.path)
+            with db:
+                cursor = db.execute('INSERT INTO sessions (started, duration, station, device, protocol, package, bytes, retries, outcome) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (self.started, self.duration, socket.gethostname(), self.device, self.protocol, self.package,
+                         sum(phase[3] for phase in self.phases if phase[0] != CONNECT_PHASE), sum(phase[6] for phase in self.phases), outcome))
+                db.executemany('INSERT INTO phases (session, phase, started, duration, bytes, protocol, outcome, retries) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(cursor.lastrowid,) + phase for phase in self.phases])
+            db.close()
+        except (sqlite3.Error, OSError) as e:
+            # Losing a history record must never fail a flash
+            sys.stderr.write('Could not record flash session: {0}\n'.format(e))
+
+def percentile(values, percent):
+    # Nearest rank
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+def throughput(nbytes, duration):
+    return nbytes / 1024 / duration if duration else 0
+
+def report(days=30, path=None, statusio=sys.stdout):
+    path = path or history_path()
+    # Reporting must not create the database, there is nothing to report without one
+    if not os.path.exists(path):
+        statusio.write('No flash sessions recorded in {0}\n'.format(path))
+        return
+    db = connect(path)
+    since = time.time() - days * 86400
+    sessions = db.execute('SELECT started, duration, station, device, protocol, package, bytes, outcome, retries FROM sessions WHERE started >= ? ORDER BY started',
+            (since,)).fetchall()
+    phase_retries = db.execute('SELECT phases.phase, SUM(phases.retries) FROM phases JOIN sessions ON phases.session = sessions.id '
+            'WHERE sessions.started >= ? AND phases.retries > 0 GROUP BY phases.phase ORDER BY phases.phase', (since,)).fetchall()
+    phases = db.execute('SELECT phases.phase, phases.duration, phases.bytes, phases.protocol FROM phases JOIN sessions ON phases.session = sessions.id '
+            'WHERE sessions.started >= ? AND phases.outcome = ? AND phases.phase != ?', (since, 'ok', CONNECT_PHASE)).fetchall()
+    db.close()
+
+    statusio.write('Flash sessions in the last {0} days: {1}\n'.format(days, len(sessions)))
+    if not sessions:
+        return
+    outcomes = {}
+    for session in sessions:
+        outcomes[session[7]] = outcomes.get(session[7], 0) + 1
+    statusio.write('Outcomes: {0}\n'.format(', '.join('{0} {1}'.format(count, outcome) for (outcome, count) in sorted(outcomes.items()))))
+    statusio.write('Retries: {0} in {1} sessions{2}\n'.format(sum(session[8] or 0 for session in sessions),
+            sum(1 for session in sessions if session[8]),
+            ''.join(', {0} {1}'.format(retries, phase) for (phase, retries) in phase_retries)))
+    durations = [session[1] for session in sessions if session[7] == 'ok']
+    statusio.write('Successful session duration: p50 {0:.1f}s, p90 {1:.1f}s, p99 {2:.1f}s\n'.format(
+            percentile(durations, 50), percentile(durations, 90), percentile(durations, 99)))
+
+    statusio.write('\nSlowest phases:\n')
+    by_phase = {}
+    for (phase, duration, nbytes, protocol) in phases:
+        by_phase.setdefault((phase, protocol), []).append((duration, nbytes))
+    ranked = sorted(by_phase.items(), key=lambda item: -sum(d for (d, _) in item[1]) / len(item[1]))
+    for ((phase, protocol), samples) in ranked:
+        times = [d for (d, _) in samples]
+        statusio.write('  {0:<14} {1:<4} n={2:<5} p50 {3:7.1f}s  p90 {4:7.1f}s  {5:8.1f} KiB/s\n'.format(
+                phase, protocol or '-', len(samples), percentile(times, 50), percentile(times, 90),
+                throughput(sum(n for (_, n) in samples), sum(times))))
+
+    statusio.write('\nDaily trend:\n')
+    by_day = {}
+    for session in sessions:
+        day = datetime.date.fromtimestamp(session[0])
+        by_day.setdefault(day, []).append(session)
+    for (day, day_sessions) in sorted(by_day.items()):
+        ok = [s for s in day_sessions if s[7] == 'ok']
+        statusio.write('  {0}  sessions {1:<4} ok {2:<4} p50 {3:7.1f}s  {4:8.1f} KiB/s\n'.format(
+                day, len(day_sessions), len(ok), percentile([s[1] for s in ok], 50),
+                throughput(sum(s[6] for s in ok), sum(s[1] for s in ok))))
+
+    statusio.write('\nBy station, port and package:\n')
+    by_station = {}
+    for session in sessions:
+        if session[7] == 'ok':
+            by_station.setdefault((session[2], session[3] or '-', session[5] or '-'), []).append(session)
+    for ((station, device, package), station_sessions) in sorted(by_station.items()):
+        statusio.write('  {0} {1} {2}: n={3}, p50 {4:.1f}s, {5:.1f} KiB/s\n'.format(
+                station, device, package, len(station_sessions), percentile([s[1] for s in station_sessions], 50),
+                throughput(sum(s[6] for s in station_sessions), sum(s[1] for s in station_sessions))))
@@ -0,0 +1,73 @@
+import sys
+import time
+
+import libusb1
+
+from fsl import cache
+
+CACHE_NAME = 'chunksize'
+CALIBRATION_SIZE = 0x100000
+UMS_CANDIDATES = (0x4000, 0x8000, 0x10000, 0x20000)
+
+def tuning_key(vybrid):
+    return '{0}:{1}'.format(vybrid.PROTOCOL, cache.device_key(vybrid.handle.getDevice()))
+
+def candidates(vybrid):
+    if vybrid.PROTOCOL == 'ums':
+        return UMS_CANDIDATES
+    # DFU blocks can be anything up to wTransferSize from the functional descriptor
+    sizes = []
+    size = 0x400
+    while size < vybrid.transfer_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(vybrid.transfer_size)
+    return sizes
+
+def calibrate(vybrid, partition, statusio=sys.stdout):
+    if not vybrid.has_partition(partition):
+        raise RuntimeError('Cannot calibrate on unknown {0} partition {1}'.format(vybrid.PROTOCOL.upper(), partition))
+    # Calibration data is written to the partition, it must be reflashed afterwards
+    data = bytes(range(256)) * (CALIBRATION_SIZE // 256)
+    results = {}
+    for chunk_size in candidates(vybrid):
+        statusio.write('\nCalibrating chunk size 0x{0:x}\n'.format(chunk_size))
+        vybrid.chunk_size = chunk_size
+        start = time.monotonic()
+        try:
+            ok = vybrid.load_image(partition, data)
+        except libusb1.USBError as e:
+            statusio.write('Chunk size 0x{0:x} failed: {1}\n'.format(chunk_size, e))
+            ok = False
+        if ok:
+            results[chunk_size] = time.monotonic() - start
+    if not results:
+        raise RuntimeError('No chunk size completed the calibration upload')
+    for (chunk_size, elapsed) in sorted(results.items()):
+        statusio.write('Chunk size 0x{0:06x}: {1:.2f}s, {2:.1f} KiB/s\n'.format(chunk_size, elapsed, CALIBRATION_SIZE / 1024 / elapsed))
+    best = min(results, key=results.get)
+    statusio.write('Using chunk size 0x{0:x} for {1}\n'.format(best, tuning_key(vybrid)))
+    tuned = cache.load(CACHE_NAME)
+    tuned[tuning_key(vybrid)] = best
+    try:
+        cache.save(CACHE_NAME, tuned)
+    except OSError as e:
+        statusio.write('Could not save tuned chunk size 0x{0:x}: {1}\n'.format(best, e))
+    vybrid.chunk_size = best
+    return best
+
+def apply(vybrid):
+    chunk_size = cache.load(CACHE_NAME).get(tuning_key(vybrid))
+    if chunk_size:
+        vybrid.chunk_size = chunk_size
+    return chunk_size
+
+def show(statusio=sys.stdout):
+    tuned = cache.load(CACHE_NAME)
+    if not tuned:
+        statusio.write('No tuned chunk sizes\n')
+    for (key, chunk_size) in sorted(tuned.items()):
+        statusio.write('{0}: 0x{1:x}\n'.format(key, chunk_size))
+
+def reset():
+    cache.save(CACHE_NAME, {})
@@ -0,0 +1,62 @@
+import binascii
+import datetime
+import re
+import struct
+
+UBOOTENV_SIZE = 0x20000
+
+# Text environments use one name=value per line, as printed by tools/envconvert.py.
+# Per-unit values are substituted for @NAME@ placeholders before encoding.
+
+def unit_values(serial):
+    serialtext = '{0:06d}'.format(serial)
+    macaddr = '{0}:{1}:{2}'.format(serialtext[:2], serialtext[2:4], serialtext[4:])
+    values = { 'SERIAL': serialtext, 'DATE': datetime.datetime.utcnow().strftime('%y%m%d%H%M%S') }
+    # Same assignment as set_serial(), 0 and 1 for fec0 and fec1, 2 and 3 for the USB gadget
+    for port in range(4):
+        values['MAC{0}'.format(port)] = '68:83:{0:02x}:{1}'.format(port, macaddr)
+    return values
+
+def render(text, serial=None):
+    values = unit_values(serial) if serial is not None else {}
+    for (name, value) in values.items():
+        text = text.replace('@{0}@'.format(name), value)
+    missing = re.search('@(SERIAL|DATE|MAC[0-3])@', text)
+    if missing:
+        raise ValueError('Environment needs a serial number for {0}'.format(missing.group(0)))
+    return text
+
+def encode(text, size=UBOOTENV_SIZE):
+    lines = [line for line in text.splitlines() if line.strip() and not line.startswith('#')]
+    for line in lines:
+        if '=' not in line:
+            raise ValueError('Environment line "{0}" is not name=value'.format(line))
+    # Variables are NUL separated, the list ends with an empty variable and the rest is padding
+    data = b'\x00'.join(line.encode('ascii') for line in lines) + b'\x00\x00'
+    if len(data) > size - 4:
+        raise ValueError('Environment is 0x{0:x} bytes, only 0x{1:x} fit'.format(len(data), size - 4))
+    data += b'\x00' * (size - 4 - len(data))
+    return struct.pack('<I', binascii.crc32(data) & 0xffffffff) + data
+
+def decode(image, verify=True):
+    (chksum,) = struct.unpack('<I', image[:4])
+    data = image[4:]
+    if verify and binascii.crc32(data) & 0xffffffff != chksum:
+        raise ValueError('Environment CRC mismatch')
+    env = data.split(b'\x00\x00', 1)[0]
+    return env.replace(b'\x00', b'\n').decode('ascii') + '\n'
+
+def is_image(data, size):
+    if len(data) != size:
+        return False
+    try:
+        decode(data)
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return True
+
+def build(data, size=UBOOTENV_SIZE, serial=None):
+    # Prebuilt images are passed through, text environments are rendered and encoded
+    if is_image(data, size):
+        return data
+    return encode(render(data.decode('ascii'), serial), size)
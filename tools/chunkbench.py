@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+# Compare upload time of geometry aligned and unaligned chunk schedules.
+# Flashes the given image to the given partition several times, so only
+# point it at a partition whose contents can be thrown away.
+
+import argparse
+import sys
+import time
+
+from fsl.flash import FlashGeometry, get_vybrid
+
+parser = argparse.ArgumentParser(description='Benchmark aligned and unaligned NAND upload chunk schedules')
+parser.add_argument('image',        help='image file to upload')
+parser.add_argument('--partition',  help='partition to upload to, mtdparts name for UMS or dfu_alt_info name for DFU (default kernel-image)', default='kernel-image')
+parser.add_argument('--runs',       help='number of uploads per schedule (default 3)', type=int, default=3)
+parser.add_argument('--page-size',  help='NAND page size in bytes (default 2048)', type=lambda x: int(x, 0), default=2048)
+parser.add_argument('--erase-size', help='NAND erase block size in bytes (default 0x20000)', type=lambda x: int(x, 0), default=0x20000)
+parser.add_argument('--oob-size',   help='NAND OOB size in bytes (default 64)', type=lambda x: int(x, 0), default=64)
+args = parser.parse_args()
+
+with open(args.image, 'rb') as f:
+    imagedata = f.read()
+
+try:
+    geometry = FlashGeometry(args.page_size, args.erase_size, args.oob_size)
+except ValueError as e:
+    parser.error(e)
+vybrid = get_vybrid(sys.stdout)
+
+# Pad up front so both schedules send the same bytes and only the chunk boundaries differ
+imagedata = geometry.pad(imagedata)
+aligned_size = geometry.chunk_size(min(vybrid.chunk_size, getattr(vybrid, 'transfer_size', vybrid.chunk_size)))
+if aligned_size <= geometry.page_size:
+    vybrid.close()
+    sys.exit('Chunk size 0x{0:x} is not larger than a page, there is no page alignment to compare'.format(aligned_size))
+# Half a page short of the aligned size, so every chunk after the first splits a page
+unaligned_size = aligned_size - geometry.page_size // 2
+
+results = { 'aligned': [], 'unaligned': [] }
+for run in range(args.runs):
+    for (name, chunk_size) in (('aligned', aligned_size), ('unaligned', unaligned_size)):
+        vybrid.geometry = None
+        vybrid.chunk_size = chunk_size
+        start = time.monotonic()
+        if not vybrid.load_image(args.partition, imagedata):
+            sys.exit('Upload failed during {0} run {1}'.format(name, run + 1))
+        results[name].append(time.monotonic() - start)
+
+print('\n{0}'.format(geometry))
+print('aligned chunk size 0x{0:x}, unaligned chunk size 0x{1:x}'.format(aligned_size, unaligned_size))
+for (name, times) in results.items():
+    mean = sum(times) / len(times)
+    print('{0:>9}: mean {1:.2f}s, best {2:.2f}s, {3:.1f} KiB/s'.format(name, mean, min(times), len(imagedata) / 1024 / mean))
+vybrid.close()
@@ -1,8 +1,38 @@
 #!/usr/bin/python3
 
+import argparse
+import importlib.util
+import os
 import sys
 
-with open(sys.argv[1], 'rb') as f:
-    chksum = f.read(4)
-    env = f.read().replace(b'\x00', b'\n').rstrip()
-    print(env.decode('ascii'))
+# Load the codec straight from the source tree, importing the fsl package would pull in Qt and libusb
+spec = importlib.util.spec_from_file_location('ubootenv', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fsl', 'ubootenv.py'))
+ubootenv = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ubootenv)
+UBOOTENV_SIZE = ubootenv.UBOOTENV_SIZE
+
+parser = argparse.ArgumentParser(description='Decode a u-boot environment image, or encode one from text')
+parser.add_argument('input',          help='environment image to decode, or text environment to encode')
+parser.add_argument('-e', '--encode', help='Encode a name=value text environment into an image', action='store_true')
+parser.add_argument('-o', '--output', help='output file (default stdout)')
+parser.add_argument('-s', '--serial', help='serial number substituted for @SERIAL@, @MAC0@-@MAC3@ and @DATE@', type=int)
+parser.add_argument('--no-verify',    help='Decode even if the environment CRC does not match', action='store_true')
+parser.add_argument('--size',         help='environment size (default 0x{0:x})'.format(UBOOTENV_SIZE), type=lambda x: int(x, 0), default=UBOOTENV_SIZE)
+args = parser.parse_args()
+
+with open(args.input, 'rb') as f:
+    data = f.read()
+
+try:
+    if args.encode:
+        result = ubootenv.encode(ubootenv.render(data.decode('ascii'), args.serial), args.size)
+    else:
+        result = ubootenv.decode(data, not args.no_verify).encode('ascii')
+except ValueError as e:
+    sys.exit('{0}: {1}'.format(args.input, e))
+
+if args.output:
+    with open(args.output, 'wb') as f:
+        f.write(result)
+else:
+    sys.stdout.buffer.write(result)